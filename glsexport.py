@@ -0,0 +1,305 @@
+'''
+    Python3 bulk export of samples and artifacts for Genologics REST API.
+
+    This module is part of the glslib package and locally imports glslib.py
+
+    Samples matching a project and/or list filter are streamed in chunks:
+    each chunk of samples is fetched concurrently, their artifacts are fetched
+    with batch_retrieve(), and one row per artifact (with the chosen UDFs and
+    container position flattened to columns) is written to CSV or NDJSON
+    before the next chunk is fetched, so memory use does not grow with the
+    size of the export. If a checkpoint file is given, an interrupted export
+    resumes after the last sample written.
+
+    Example:
+
+    from glsapi import glslib, glsexport
+    glslib.register('exampleserver')
+    glsexport.export('out.csv', projectlimsid='ABC123',
+                     sampleudfs=['Sample Type'], artifactudfs=['Concentration'],
+                     checkpoint='out.csv.ckpt')
+
+    This library is free software: you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library. If not, see <http://www.gnu.org/licenses/>
+'''
+import os
+import os.path
+import csv
+import json
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+import urllib.error
+from urllib.parse import urlencode
+from . import glslib
+from . import glsxml
+
+FORMATS = ('csv', 'ndjson')
+SAMPLECOLUMNS = ['project', 'sample_limsid', 'sample_name']
+ARTIFACTCOLUMNS = ['artifact_limsid', 'artifact_name', 'artifact_type',
+                   'container_limsid', 'well']
+MSGBADFORMAT = '''
+Export format must be one of %s''' % ', '.join(FORMATS)
+MSGRESUMING = '''
+Resuming export to %s after %d samples'''
+MSGMISSINGARTIFACT = '''
+Artifact %s not found. Skipped.'''
+MSGMISSINGSAMPLE = '''
+Sample %s not found. Skipped.'''
+MSGRESUMEPOINTMOVED = '''
+Last exported sample %s is no longer on list page %s. Searching whole list.'''
+MSGRESUMEPOINTGONE = '''
+Cannot resume: last exported sample %s is no longer in the list'''
+MSGCHECKPOINTMISMATCH = '''
+Checkpoint %s is for a different export:
+%s
+Remove it or export with the same parameters.'''
+
+
+class GlsexportException(Exception):
+    pass
+
+
+def iter_links(uri, tag):
+    '''
+    Yield uri of each <tag> element in the list resource at uri, following
+    next-page links.
+    '''
+    while uri:
+        page = glslib.get(uri)
+        for elem in glsxml.findall(page, tag):
+            yield elem.get('uri')
+        nextpage = glsxml.find(page, 'next-page')
+        uri = nextpage.get('uri') if nextpage is not None else None
+
+
+def udf_values(elem, names):
+    '''
+    Return list of text of udf:field children of elem named in names, with
+    '' for any that are absent.
+    '''
+    udfs = { f.get('name'): f.text or ''
+             for f in glsxml.findall(elem, '{%s}field' % glslib._NSMAP['udf']) }
+    return [ udfs.get(n, '') for n in names ]
+
+
+def columns(sampleudfs=(), artifactudfs=()):
+    '''
+    Return list of column names of rows produced with the given udfs.
+    '''
+    return (SAMPLECOLUMNS + [ 'sample.%s' % n for n in sampleudfs ] +
+            ARTIFACTCOLUMNS + [ 'artifact.%s' % n for n in artifactudfs ])
+
+
+def _sample_values(sample, sampleudfs):
+    project = glsxml.find(sample, 'project')
+    return ([ project.get('limsid') if project is not None else '',
+              sample.get('limsid'),
+              glsxml.findtext(sample, 'name', '') ] +
+            udf_values(sample, sampleudfs))
+
+
+def _artifact_values(artifact, artifactudfs):
+    container = glsxml.find(artifact, 'location/container')
+    return ([ artifact.get('limsid'),
+              glsxml.findtext(artifact, 'name', ''),
+              glsxml.findtext(artifact, 'type', ''),
+              container.get('limsid') if container is not None else '',
+              glsxml.findtext(artifact, 'location/value', '') ] +
+            udf_values(artifact, artifactudfs))
+
+
+def _get_or_none(uri):
+    '''
+    glslib.get(uri), or None if the resource no longer exists.
+    '''
+    try:
+        return glslib.get(uri)
+    except urllib.error.HTTPError as httperr:
+        if httperr.code != 404:
+            raise
+        return None
+
+
+def _fetch_artifacts(executor, uris, batchsize):
+    '''
+    Return list of artifacts at uris. Any that are not returned, e.g.
+    deleted since they were listed, are logged and left out.
+    '''
+    uris = list(uris)
+    if glslib._batch_supported():
+        batches = [ uris[i:i + batchsize]
+                    for i in range(0, len(uris), batchsize) ]
+        results = executor.map(glslib.batch_retrieve, batches)
+        artifacts = [ a for batch in results for a in batch ]
+    else:
+        artifacts = [ a for a in executor.map(_get_or_none, uris) 
+                      if a is not None ]
+    found = { glslib._tracking_key(a.get('uri')) for a in artifacts }
+    for uri in uris:
+        if glslib._tracking_key(uri) not in found:
+            glslib.logger.warning(MSGMISSINGARTIFACT % uri)
+    return artifacts
+
+
+def iter_rows(executor, sampleuris, sampleudfs=(), artifactudfs=(),
+              batchsize=100):
+    '''
+    Yield one row (list of values, see columns()) per artifact of each sample
+    in sampleuris, fetching concurrently using executor. The artifacts of 
+    all the samples are listed with one (paged) query.
+    '''
+    samples = []
+    for uri, sample in zip(sampleuris, executor.map(_get_or_none, sampleuris)):
+        if sample is None:
+            glslib.logger.warning(MSGMISSINGSAMPLE % uri)
+        else:
+            samples.append(sample)
+    if not samples:
+        return
+    limsids = [ s.get('limsid') for s in samples ]
+    listuri = 'artifacts?%s' % urlencode({'samplelimsid': limsids}, doseq=True)
+    artifacts = _fetch_artifacts(executor, iter_links(listuri, 'artifact'),
+                                 batchsize)
+    bysample = { limsid: [] for limsid in limsids }
+    for artifact in artifacts:
+        # Pooled artifacts have several samples
+        for s in glsxml.findall(artifact, 'sample'):
+            if s.get('limsid') in bysample:
+                bysample[s.get('limsid')].append(artifact)
+    for sample in samples:
+        samplevalues = _sample_values(sample, sampleudfs)
+        for artifact in bysample[sample.get('limsid')]:
+            yield samplevalues + _artifact_values(artifact, artifactudfs)
+
+
+def _iter_samples(listuri, pageuri=None, after=None):
+    '''
+    Yield (pageuri, sampleuri, limsid) for each sample in the list resource
+    at listuri. If pageuri is given start at that page, and if after is 
+    given start after the sample with that limsid. If it is no longer on 
+    that page (e.g. an earlier sample was deleted, shifting the pages) the
+    list is searched from the start; if it is not in the list at all, raise
+    GlsexportException.
+    '''
+    uri = pageuri or listuri
+    while uri:
+        page = glslib.get(uri)
+        samples = glsxml.findall(page, 'sample')
+        nextpage = glsxml.find(page, 'next-page')
+        if after is not None:
+            limsids = [ s.get('limsid') for s in samples ]
+            if after in limsids:
+                samples = samples[limsids.index(after) + 1:]
+                after = None
+            elif uri == pageuri:
+                glslib.logger.warning(MSGRESUMEPOINTMOVED % (after, uri))
+                uri = listuri
+                continue
+            elif nextpage is None:
+                raise GlsexportException(MSGRESUMEPOINTGONE % after)
+            else:
+                samples = []
+        for s in samples:
+            yield uri, s.get('uri'), s.get('limsid')
+        uri = nextpage.get('uri') if nextpage is not None else None
+
+
+def _read_checkpoint(checkpoint, params):
+    '''
+    Return checkpoint state dictionary, or None if there is none.
+    Raise GlsexportException if it was written with different params.
+    '''
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as fh:
+            state = json.load(fh)
+        if state.get('params') != params:
+            raise GlsexportException(MSGCHECKPOINTMISMATCH % 
+                                     (checkpoint, state.get('params')))
+        return state
+    return None
+
+
+def _write_checkpoint(checkpoint, state):
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w') as fh:
+        json.dump(state, fh)
+    os.rename(tmp, checkpoint)
+
+
+def export(outfile, fmt='csv', projectlimsid=None, query=None,
+           sampleudfs=(), artifactudfs=(), checkpoint=None, chunksize=100,
+           batchsize=100, workers=4):
+    '''
+    Export one row per artifact of each matching sample to outfile.
+    Return number of samples exported.
+
+    'outfile' is path of output file
+    'fmt' is 'csv' or 'ndjson'
+    'projectlimsid' restricts export to samples of one project
+    'query' is a dictionary of further filters for the samples list resource
+    'sampleudfs', 'artifactudfs' are lists of udf names to export as columns
+    'checkpoint' is path of a checkpoint file. If it exists the export
+     resumes from it, provided outfile, fmt, filters and udfs are the same
+     as when it was written. It records the list page and limsid of the last
+     sample exported; resuming fails if that sample is no longer on that
+     page. It is removed when the export completes.
+    'chunksize' is number of samples fetched and written per step
+    'batchsize' is number of artifacts per batch_retrieve()
+    'workers' is number of concurrent requests
+    '''
+    if fmt not in FORMATS:
+        raise GlsexportException(MSGBADFORMAT)
+    query = dict(query or {})
+    if projectlimsid:
+        query['projectlimsid'] = projectlimsid
+    listuri = 'samples?%s' % urlencode(query) if query else 'samples'
+    names = columns(sampleudfs, artifactudfs)
+    # Anything that changes which rows, or their format, must match to resume
+    params = {'outfile': os.path.abspath(outfile), 'fmt': fmt, 
+              'listuri': listuri, 'columns': names}
+    state = _read_checkpoint(checkpoint, params)
+    if state:
+        glslib.logger.info(MSGRESUMING % (outfile, state['samples']))
+        # Discard anything written after the last checkpoint
+        with open(outfile, 'r+') as fh:
+            fh.truncate(state['offset'])
+        samples = _iter_samples(listuri, state['page'], state['last'])
+    else:
+        state = {'params': params, 'samples': 0}
+        samples = _iter_samples(listuri)
+    with open(outfile, 'a' if state['samples'] else 'w', newline='') as fh, \
+         ThreadPoolExecutor(max_workers=workers) as executor:
+        writer = csv.writer(fh)
+        if fmt == 'csv' and not state['samples']:
+            writer.writerow(names)
+        while True:
+            chunk = list(islice(samples, chunksize))
+            if not chunk:
+                break
+            sampleuris = [ uri for page, uri, limsid in chunk ]
+            for row in iter_rows(executor, sampleuris, sampleudfs, 
+                                 artifactudfs, batchsize):
+                if fmt == 'csv':
+                    writer.writerow(row)
+                else:
+                    fh.write(json.dumps(dict(zip(names, row))) + '\n')
+            fh.flush()
+            state['samples'] += len(chunk)
+            state['page'], _, state['last'] = chunk[-1]
+            state['offset'] = os.fstat(fh.fileno()).st_size
+            if checkpoint:
+                _write_checkpoint(checkpoint, state)
+            glslib.logger.info('Exported %d samples' % state['samples'])
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return state['samples']
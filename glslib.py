@@ -7,6 +7,8 @@
     preserve such accidental backwards-compatibility.
 
     This module exposes ElementTree-style interface for xml operations. 
+    Elements are lxml.etree elements if lxml is installed, otherwise 
+    xml.etree.ElementTree elements; see glsxml.py.
     
     This module uses logging and has one module-level Logger named "__name__".
     Assuming this module is used as part of package "glsapi", this logger may
@@ -32,9 +34,13 @@ import os.path
 import sys
 import logging
 import base64
+import hashlib
 import urllib.request, urllib.error
 import re
-import xml.etree.ElementTree as etree
+import threading
+from . import glsxml
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 
 
@@ -53,6 +59,32 @@ _BASEURI = None
 _AUTHSTR = None
 _GLSFTPAUTH = None
 _NSPATTERN = re.compile(r'(\{)(.+?)(\})')
+# Fingerprints of resources as last seen on the server, keyed by
+# query-stripped uri, least recently tracked first. See track() and 
+# is_dirty().
+_FINGERPRINTS = OrderedDict()
+_FINGERPRINTSLOCK = threading.Lock()
+_FINGERPRINTSIZE = 100000
+# Pending writes while a unit of work is open. See begin_unit_of_work().
+_UNITOFWORK = None
+_BATCHSIZE = 500
+_WORKERS = 4
+# GETs in progress, keyed by absolute uri. See get().
+_INFLIGHT = {}
+_INFLIGHTLOCK = threading.Lock()
+# Prefetched resources, keyed by absolute uri. See enable_prefetch().
+_PREFETCHRULES = None
+_PREFETCHED = OrderedDict()
+_PREFETCHLOCK = threading.Lock()
+_PREFETCHSIZE = 10000
+# {query-stripped uri:set of uris} of _PREFETCHED, see uncache()
+_PREFETCHKEYS = {}
+_PREFETCHEXECUTOR = None
+# Default {resource type:reference tags} followed by the prefetch planner
+PREFETCHRULES = {
+'process':('input', 'output', 'parent-process'),
+'artifact':('sample', 'container', 'parent-process'),
+}
 _NSMAP = {
 'artgr':'http://genologics.com/ri/artifactgroup',
 'art':'http://genologics.com/ri/artifact',
@@ -76,9 +108,12 @@ _NSMAP = {
 'udf':'http://genologics.com/ri/userdefined',
 'ver':'http://genologics.com/ri/version',
 }
-_NSREV = { v:k for k, v in _NSMAP.items() }
-# Deal with ns prefixes in ElementTree by registering in _namespace_map
-etree._namespace_map.update(_NSREV)
+# Deal with ns prefixes by registering them with the xml backend
+glsxml.register_namespaces(_NSMAP)
+# Kept for code that uses glslib.etree. This is the xml backend module
+# selected at import and is NOT updated by glsxml.use_backend(); use
+# glsxml.etree for the current backend.
+etree = glsxml.etree
     
 MSGBADCREDENTIALFILEFORMAT = '''
 Credentials file must contain only lines of the form
@@ -95,6 +130,18 @@ MSGBADTAGFORMAT = '''
 'Tag "%s" is not in etree format {namespace}local'''
 MSGBATCHMETHODNOTIMPLEMENTED = '''
 API version detected is < 13. Batch methods not implemented.'''
+MSGSKIPPEDUNCHANGED = '''
+Skipped unchanged %s'''
+MSGUNITOFWORKOPEN = '''
+A unit of work is already open.'''
+MSGNOUNITOFWORK = '''
+No unit of work is open.'''
+MSGFLUSHFAILED = '''
+%d of %d writes failed while committing unit of work.'''
+MSGWRITEFAILED = '''
+Write failed for:
+%s
+%s'''
 
 
 def version():
@@ -132,7 +179,7 @@ def Element(tag, _text_=None, **extra):
     instead of standard ElementTree-style "{namespace}local"
     '''
     tag = _expand_tag(tag)
-    e = etree.Element(tag, **extra)        
+    e = glsxml.Element(tag, **extra)        
     e.text = _text_
     return e
 
@@ -144,7 +191,7 @@ def SubElement(parent, tag, _text_=None, **extra):
     instead of standard ElementTree-style "{namespace}local"
     '''
     tag = _expand_tag(tag)
-    se = etree.SubElement(parent, tag, **extra)
+    se = glsxml.SubElement(parent, tag, **extra)
     se.text = _text_
     return se
 
@@ -153,7 +200,7 @@ def SubElement(parent, tag, _text_=None, **extra):
 # a convenient (and slow) fallback using standard library: 
 def pprint(elem):
     from xml.dom.minidom import parseString
-    txt = etree.tostring(elem)
+    txt = glsxml.tostring(elem)
     print(parseString(txt).toprettyxml()) 
 
 
@@ -195,7 +242,7 @@ def make_project_elem(nametxt, researcher, opendate=None, udts=None, udfs=None):
     SubElement(prjelem, 'researcher', 
                uri='%s/researchers/%s'%(_BASEURI, str(researcher)))
     add_ud_elems(prjelem, udts, udfs)
-    logger.debug(etree.tostring(prjelem, 'unicode'))
+    logger.debug(glsxml.tostring(prjelem, 'unicode'))
     return prjelem
 
 
@@ -213,7 +260,7 @@ def make_container_elem(nametxt, contype, udts=None, udfs=None):
     SubElement(contelem, 'type', 
                uri='%s/containertypes/%s' % (_BASEURI, str(contype)))
     add_ud_elems(contelem, udts, udfs)
-    logger.debug(etree.tostring(contelem, 'unicode'))
+    logger.debug(glsxml.tostring(contelem, 'unicode'))
     return contelem
 
 
@@ -239,10 +286,68 @@ def make_sample_elem(nametxt, project, container, locationtxt,
     locelem = SubElement(smpelem, 'location')
     SubElement(locelem, 'container', limsid=container)
     SubElement(locelem, 'value', locationtxt)
-    logger.debug(etree.tostring(smpelem, 'unicode'))
+    logger.debug(glsxml.tostring(smpelem, 'unicode'))
     return smpelem
 
 
+#---------------------------------------------------------
+# These functions are for tracking changes to fetched data
+#---------------------------------------------------------
+def _tracking_key(uri):
+    '''
+    Strip any query (e.g. artifact "?state=") from uri
+    '''
+    return uri.split('?')[0] if uri else uri
+
+
+def fingerprint(resource):
+    '''
+    Return compact digest of the serialized resource.
+    '''
+    return hashlib.sha1(glsxml.tostring(resource)).digest()
+
+
+def track(resource):
+    '''
+    Record fingerprint of resource as it currently exists on the server.
+    Called automatically by get(), batch_retrieve() and the update methods.
+    Resources without a uri attribute (e.g. lists) are not tracked.
+    Only the most recent _FINGERPRINTSIZE resources are remembered; older
+    ones count as never fetched, i.e. dirty.
+    '''
+    key = _tracking_key(resource.get('uri'))
+    if key:
+        digest = fingerprint(resource)
+        with _FINGERPRINTSLOCK:
+            _FINGERPRINTS[key] = digest
+            _FINGERPRINTS.move_to_end(key)
+            while len(_FINGERPRINTS) > _FINGERPRINTSIZE:
+                _FINGERPRINTS.popitem(last=False)
+    return resource
+
+
+def untrack(uri=None):
+    '''
+    Forget recorded fingerprint for uri, or all fingerprints if uri is None.
+    '''
+    with _FINGERPRINTSLOCK:
+        if uri is None:
+            _FINGERPRINTS.clear()
+        else:
+            _FINGERPRINTS.pop(_tracking_key(uri), None)
+
+
+def is_dirty(resource):
+    '''
+    Return False only if resource is known to be unchanged since it was 
+    fetched. Resources that were never fetched are always dirty.
+    '''
+    key = _tracking_key(resource.get('uri'))
+    with _FINGERPRINTSLOCK:
+        digest = _FINGERPRINTS.get(key)
+    return digest != fingerprint(resource)
+
+
 #----------------------------------------------
 # These functions are for setting/getting data
 #----------------------------------------------
@@ -291,13 +396,27 @@ def set_api_version():
     '''
     global _APIVERSION, _BASEURI
     ver = get('') # _BASEURI is versionless at this point
-    version = ver.find('version')
+    version = glsxml.find(ver, 'version')
     major = version.get('major')
     minor = version.get('minor')
     _APIVERSION = '.'.join([major, minor])
     _BASEURI = os.path.join(_BASEURI, major)
     
     
+def _batch_supported():
+    '''
+    True if API version >= v1.r13, i.e. batch methods are available
+    '''
+    major, minor = [ int(i.lstrip('vr')) for i in _APIVERSION.split('.') ]
+    return not (major == 0 or (major == 1 and minor < 13))
+
+
+def _absolute_uri(uri):
+    if not uri.startswith(_BASEURI):
+        uri = _BASEURI.rstrip('/') + '/' + uri.lstrip('/')
+    return uri
+
+
 def glsrequest(uri, method, data=None):
     '''
     Returns xml node tree as Element instance.
@@ -308,13 +427,12 @@ def glsrequest(uri, method, data=None):
     '''
     if method not in {'GET', 'POST', 'PUT'}:
         raise GlslibException(MSGUNSUPPORTEDMETHOD % method)
-    if not uri.startswith(_BASEURI):
-        uri = _BASEURI.rstrip('/') + '/' + uri.lstrip('/')
+    uri = _absolute_uri(uri)
     request = urllib.request.Request(uri)
     request.add_header("Authorization", "Basic %s" % _AUTHSTR)
-    if etree.iselement(data):
+    if glsxml.iselement(data):
         # tostring generates bytestring (as required for data)
-        data = etree.tostring(data)
+        data = glsxml.tostring(data)
         request.add_header('Content-Type', 'application/xml')
     request.add_data(data)
     request.get_method = lambda: method
@@ -325,7 +443,7 @@ def glsrequest(uri, method, data=None):
     logger.debug(msg)
     try:
         r = urllib.request.urlopen(request)
-        return etree.XML(r.read())
+        return glsxml.fromstring(r.read())
     except urllib.error.HTTPError as httperr:
         logger.error(httperr.read())
         raise
@@ -334,21 +452,132 @@ def glsrequest(uri, method, data=None):
         raise
     
     
+class _InFlight(object):
+    '''
+    A GET in progress, shared by all threads requesting the same uri.
+    A flight is stale if the resource was written, or uncached, while it was
+    in progress: its result is then not tracked or cached and its waiters
+    fetch again.
+    '''
+    def __init__(self, prefetch=False):
+        self.done = threading.Event()
+        self.prefetch = prefetch
+        self.stale = False
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+
+def _join_flight(uri, prefetch=False):
+    '''
+    Return (flight, True) for a new flight that the caller must complete with
+    _land_flight(), or (flight, False) for one already in progress.
+    '''
+    with _INFLIGHTLOCK:
+        flight = _INFLIGHT.get(uri)
+        if flight is not None:
+            flight.waiters += 1
+            return flight, False
+        flight = _INFLIGHT[uri] = _InFlight(prefetch)
+        return flight, True
+
+
+def _land_flight(uri, flight, result=None, error=None):
+    '''
+    Complete flight, giving waiters their own copy of result.
+    '''
+    with _INFLIGHTLOCK:
+        # Stale flights have already been replaced or removed
+        if _INFLIGHT.get(uri) is flight:
+            del _INFLIGHT[uri]
+        if result is not None and flight.waiters:
+            result = deepcopy(result)
+    flight.result, flight.error = result, error
+    flight.done.set()
+
+
+def _coalesced_get(uri, prefetch=False):
+    '''
+    GET absolute uri, sharing one request between concurrent callers.
+    A prefetch caches the result instead of tracking it; whoever takes it
+    from a prefetch flight or the cache tracks their copy.
+    '''
+    flight, leader = _join_flight(uri, prefetch)
+    if not leader:
+        flight.done.wait()
+        if flight.stale or (flight.result is None and flight.prefetch):
+            # Overtaken by a write, or failed prefetch: fetch it ourselves
+            return _coalesced_get(uri)
+        if flight.result is None:
+            raise flight.error
+        result = deepcopy(flight.result)
+        return track(result) if flight.prefetch else result
+    try:
+        result = glsrequest(uri, 'GET')
+    except Exception as e:
+        _land_flight(uri, flight, error=e)
+        raise
+    # Under _PREFETCHLOCK, as uncache() marks flights stale, and before
+    # waking waiters so that their writes uncache what is cached here
+    with _PREFETCHLOCK:
+        if not flight.stale:
+            if prefetch:
+                _cache_locked(uri, result)
+            else:
+                track(result)
+    _land_flight(uri, flight, result)
+    return result
+
+
 def get(uri):
     '''
     Return Element representation of resource at uri.
-    '''
-    return glsrequest(uri, 'GET')
+    
+    Concurrent GETs of the same uri share one request. If prefetch is 
+    enabled, a prefetched copy is returned if there is one, and resources 
+    referenced by the result are prefetched in the background.
+    '''
+    uri = _absolute_uri(uri)
+    resource = _cached(uri) if _PREFETCHRULES is not None else None
+    if resource is None:
+        resource = _coalesced_get(uri)
+    if _PREFETCHRULES is not None:
+        prefetch(resource)
+    return resource
     
     
-def update(resource):
+def update(resource, force=False):
     '''
     PUT an updated version of resource to the system.
     
     'resource' must be a valid Element representation of existing resource.
     'resource' must be a full representation. Missing elements are deleted.
-    '''
-    return glsrequest(resource.get('uri'), 'PUT', resource)
+    'force' PUT even if resource is unchanged since fetched. Otherwise an
+     unchanged resource is not sent, and is itself returned.
+    Within a unit of work the PUT is queued and resource is returned. An
+     unchanged resource replaces any earlier queued write of it.
+    '''
+    if not force and not is_dirty(resource):
+        logger.info(MSGSKIPPEDUNCHANGED % resource.get('uri'))
+        if _UNITOFWORK is not None:
+            # Reverted to what the server has: drop any earlier queued write
+            _UNITOFWORK.discard(resource)
+        return resource
+    uncache(resource.get('uri'))
+    if _UNITOFWORK is not None:
+        _UNITOFWORK.put(resource)
+        return resource
+    return _put(resource)
+
+
+def _put(resource):
+    uri = resource.get('uri')
+    # Before: GETs started from now on wait for the write. After: drop
+    # anything fetched while it was in progress.
+    uncache(uri)
+    response = glsrequest(uri, 'PUT', resource)
+    uncache(uri)
+    return track(response)
 
 
 def add_new(resource, listuri=None):
@@ -357,6 +586,7 @@ def add_new(resource, listuri=None):
     
     'resource' must be a valid Element representation, including tag
      specified like '{namespace}local' 
+    Within a unit of work the POST is queued and None is returned.
     '''
     # If listuri not specified, try to guess it by pluralizing tag namespace
     if not listuri:
@@ -365,6 +595,13 @@ def add_new(resource, listuri=None):
             listuri = '/%ss' % (ns.split('/')[-1])
         except AttributeError:
             raise GlslibException(MSGBADTAGFORMAT % resource.tag)
+    if _UNITOFWORK is not None:
+        _UNITOFWORK.post(resource, listuri)
+        return None
+    return _post(resource, listuri)
+
+
+def _post(resource, listuri):
     return glsrequest(listuri, 'POST', resource)
 
 
@@ -375,32 +612,398 @@ def batch_retrieve(uris):
     
     'uris' is any iterable of uris.
     '''
-    major, minor = [ int(i.lstrip('vr')) for i in _APIVERSION.split('.') ]
-    if major == 0 or (major == 1 and minor < 13):   
+    artifacts = _batch_get(uris)
+    for art in artifacts:
+        track(art)
+    return artifacts
+
+
+def _batch_get(uris):
+    '''
+    batch_retrieve() without tracking
+    '''
+    if not _batch_supported():
         raise GlslibException(MSGBATCHMETHODNOTIMPLEMENTED)
     payload = Element('ri:links')
     for uri in uris:
         SubElement(payload, 'link', uri=uri, rel='artifacts')
     response = glsrequest('artifacts/batch/retrieve', 'POST', payload)
-    return response.findall('.//{%s}artifact' % _NSMAP['art'])
+    return glsxml.findall(response, './/{%s}artifact' % _NSMAP['art'])
 
 
-def batch_update(artifacts):
+def batch_update(artifacts, force=False):
     '''
     Batch update supplied list of artifacts
     API version >= v1.r13 only
     
+    Return list of uris of artifacts skipped because they are unchanged 
+    since fetched.
+    
     'artifacts' is any iterable of artifacts.
+    'force' send all artifacts, changed or not.
     '''
-    major, minor = [ int(i.lstrip('vr')) for i in _APIVERSION.split('.') ]
-    if major == 0 or (major == 1 and minor < 13):        
+    if not _batch_supported():
         raise GlslibException(MSGBATCHMETHODNOTIMPLEMENTED)
+    changed, skipped = [], []
+    for art in artifacts:
+        if not force and not is_dirty(art):
+            logger.info(MSGSKIPPEDUNCHANGED % art.get('uri'))
+            skipped.append(art.get('uri'))
+            if _UNITOFWORK is not None:
+                _UNITOFWORK.discard(art)
+            continue
+        changed.append(art)
+        uncache(art.get('uri'))
+    if _UNITOFWORK is not None:
+        for art in changed:
+            _UNITOFWORK.put(art)
+        return skipped
+    if changed:
+        _batch_put(changed)
+    return skipped
+
+
+def _batch_put(artifacts):
     payload = Element('art:details')
     for art in artifacts:
+        uncache(art.get('uri'))
         # lxml elements can be in only one tree at a time.
         # deepcopy here will preserve namespace declarations in artifact tag
         payload.append(deepcopy(art))
     response = glsrequest('artifacts/batch/update', 'POST', payload)
-    updated = response.findall('link')
+    for art in artifacts:
+        uncache(art.get('uri'))
+        track(art)
+    updated = glsxml.findall(response, 'link')
     for u in updated:
         logger.info('%s %s' % ("Updated", u.get('uri')))
+
+
+
+#-------------------------------------------------------------------
+# These functions are for deferring writes until an explicit commit
+#-------------------------------------------------------------------
+class _UnitOfWork(object):
+    '''
+    Queue of pending writes. PUTs are merged per uri so the last write
+    wins; POSTs are kept, and sent, in order.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.puts = OrderedDict()
+        self.posts = []
+
+    def put(self, resource):
+        key = _tracking_key(resource.get('uri'))
+        with self.lock:
+            self.puts.pop(key, None)
+            self.puts[key] = deepcopy(resource)
+
+    def discard(self, resource):
+        with self.lock:
+            self.puts.pop(_tracking_key(resource.get('uri')), None)
+
+    def post(self, resource, listuri):
+        with self.lock:
+            self.posts.append((deepcopy(resource), listuri))
+
+    def take(self):
+        '''
+        Return and clear pending (puts, posts)
+        '''
+        with self.lock:
+            puts, posts = list(self.puts.values()), self.posts
+            self.puts, self.posts = OrderedDict(), []
+        return puts, posts
+
+    def restore(self, puts, posts):
+        '''
+        Put back writes that failed to send, ahead of anything queued since.
+        A PUT queued since for the same uri is newer and is kept instead.
+        '''
+        with self.lock:
+            for resource in puts:
+                key = _tracking_key(resource.get('uri'))
+                if key not in self.puts:
+                    self.puts[key] = resource
+                    self.puts.move_to_end(key, last=False)
+            self.posts = posts + self.posts
+
+    def __len__(self):
+        with self.lock:
+            return len(self.puts) + len(self.posts)
+
+
+def begin_unit_of_work():
+    '''
+    Open a unit of work. Until end_unit_of_work(), update(), batch_update()
+    and add_new() only queue their writes (add_new() returns None) and 
+    nothing is sent until commit().
+    '''
+    global _UNITOFWORK
+    if _UNITOFWORK is not None:
+        raise GlslibException(MSGUNITOFWORKOPEN)
+    _UNITOFWORK = _UnitOfWork()
+
+
+def in_unit_of_work():
+    return _UNITOFWORK is not None
+
+
+def pending():
+    '''
+    Return number of writes queued in the open unit of work (0 if none).
+    '''
+    return len(_UNITOFWORK) if _UNITOFWORK is not None else 0
+
+
+def commit(batchsize=None, workers=None):
+    '''
+    Send all writes queued in the open unit of work, which stays open.
+    Artifacts are sent with batch updates in batches of 'batchsize' and
+    other PUTs one per request, concurrently by 'workers' threads (one at
+    a time, without a thread pool, if 'workers' is 1). POSTs are then sent
+    one at a time in the order they were queued.
+    Raise GlslibException if any write fails; the others are still sent,
+    the uris that failed are logged, and the failed writes are put back in
+    the queue so they can be retried with commit() or dropped with 
+    rollback().
+    '''
+    if _UNITOFWORK is None:
+        raise GlslibException(MSGNOUNITOFWORK)
+    batchsize = batchsize or _BATCHSIZE
+    workers = workers or _WORKERS
+    puts, posts = _UNITOFWORK.take()
+    if not (puts or posts):
+        return
+    artifacts, others = [], []
+    for r in puts:
+        if _batch_supported() and '/artifacts/' in r.get('uri'):
+            artifacts.append(r)
+        else:
+            others.append(r)
+    tasks = [ (_batch_put, artifacts[i:i + batchsize]) 
+              for i in range(0, len(artifacts), batchsize) ]
+    tasks += [ (_put, r) for r in others ]
+    if workers == 1:
+        # No executor: it cannot be used at interpreter shutdown (atexit)
+        errors = []
+        for send, arg in tasks:
+            try:
+                send(arg)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [ executor.submit(send, arg) for send, arg in tasks ]
+            errors = [ f.exception() for f in futures ]
+    failedputs, failedposts = [], []
+    for (send, arg), e in zip(tasks, errors):
+        if e is not None:
+            resources = arg if send is _batch_put else [arg]
+            uris = [ r.get('uri') for r in resources ]
+            logger.error(MSGWRITEFAILED % ('\n'.join(uris), e))
+            failedputs += resources
+    for r, listuri in posts:
+        try:
+            _post(r, listuri)
+        except Exception as e:
+            logger.error(MSGWRITEFAILED % (listuri, e))
+            failedposts.append((r, listuri))
+    if failedputs or failedposts:
+        _UNITOFWORK.restore(failedputs, failedposts)
+        raise GlslibException(MSGFLUSHFAILED % 
+                              (len(failedputs) + len(failedposts), 
+                               len(puts) + len(posts)))
+
+
+def rollback():
+    '''
+    Discard all writes queued in the open unit of work, which stays open.
+    '''
+    if _UNITOFWORK is None:
+        raise GlslibException(MSGNOUNITOFWORK)
+    puts, posts = _UNITOFWORK.take()
+    if puts or posts:
+        logger.info('Discarded %d pending writes' % (len(puts) + len(posts)))
+
+
+def end_unit_of_work(save=True, batchsize=None, workers=None):
+    '''
+    commit() or rollback() the open unit of work, then close it so that 
+    writes are sent immediately again. 'batchsize' and 'workers' are passed
+    to commit().
+    '''
+    global _UNITOFWORK
+    try:
+        if save:
+            commit(batchsize, workers)
+        else:
+            rollback()
+    finally:
+        _UNITOFWORK = None
+
+
+
+#-----------------------------------------------------------------
+# These functions are for prefetching resources referenced by GETs
+#-----------------------------------------------------------------
+def enable_prefetch(rules=None, workers=None, cachesize=None):
+    '''
+    After each get(), fetch in the background the resources it references
+    so that later get()s of them are served locally.
+    
+    'rules' is a dictionary mapping resource type (local tag of the root
+     element e.g. 'process') to tags whose uri attribute is followed
+     (default=PREFETCHRULES)
+    'workers' is number of background threads (default=_WORKERS)
+    'cachesize' is the maximum number of resources kept (default=10000)
+    
+    Prefetched resources are not refreshed, so only enable prefetch where
+    they are not changed by others during the script. update() and 
+    batch_update() discard prefetched copies of what they write.
+    '''
+    global _PREFETCHRULES, _PREFETCHSIZE, _PREFETCHEXECUTOR
+    _PREFETCHRULES = { k: tuple(v) for k, v in (rules or PREFETCHRULES).items() }
+    _PREFETCHSIZE = cachesize or _PREFETCHSIZE
+    if _PREFETCHEXECUTOR is not None:
+        _PREFETCHEXECUTOR.shutdown(wait=False)
+    _PREFETCHEXECUTOR = ThreadPoolExecutor(max_workers=workers or _WORKERS)
+
+
+def disable_prefetch():
+    '''
+    Stop prefetching and discard prefetched resources.
+    '''
+    global _PREFETCHRULES, _PREFETCHEXECUTOR
+    _PREFETCHRULES = None
+    if _PREFETCHEXECUTOR is not None:
+        _PREFETCHEXECUTOR.shutdown(wait=True)
+        _PREFETCHEXECUTOR = None
+    uncache()
+
+
+def _cached(uri):
+    '''
+    Return copy of prefetched resource at absolute uri, or None.
+    '''
+    with _PREFETCHLOCK:
+        resource = _PREFETCHED.get(uri)
+        if resource is None:
+            return None
+        _PREFETCHED.move_to_end(uri)
+        resource = deepcopy(resource)
+    return track(resource)
+
+
+def _cache_locked(uri, resource):
+    '''
+    Cache resource at absolute uri. Caller must hold _PREFETCHLOCK.
+    '''
+    _PREFETCHED[uri] = resource
+    _PREFETCHED.move_to_end(uri)
+    _PREFETCHKEYS.setdefault(_tracking_key(uri), set()).add(uri)
+    while len(_PREFETCHED) > _PREFETCHSIZE:
+        old, _ = _PREFETCHED.popitem(last=False)
+        key = _tracking_key(old)
+        _PREFETCHKEYS[key].discard(old)
+        if not _PREFETCHKEYS[key]:
+            del _PREFETCHKEYS[key]
+
+
+def uncache(uri=None):
+    '''
+    Discard prefetched copies of resource at uri under any "?state=", or
+    all if uri is None. GETs of it in progress are marked stale so that
+    their results are not cached or tracked, and later GETs do not join
+    them.
+    '''
+    key = _tracking_key(_absolute_uri(uri)) if uri is not None else None
+    with _INFLIGHTLOCK:
+        with _PREFETCHLOCK:
+            for u in list(_INFLIGHT):
+                if key is None or _tracking_key(u) == key:
+                    _INFLIGHT.pop(u).stale = True
+            if key is None:
+                _PREFETCHED.clear()
+                _PREFETCHKEYS.clear()
+            else:
+                for u in _PREFETCHKEYS.pop(key, ()):
+                    del _PREFETCHED[u]
+
+
+def references(resource, rules=None):
+    '''
+    Return set of absolute uris referenced by resource that 'rules' 
+    (default=rules given to enable_prefetch(), else PREFETCHRULES) say to 
+    follow.
+    '''
+    rules = rules or _PREFETCHRULES or PREFETCHRULES
+    rtype = resource.tag.split('}')[-1]
+    uris = set()
+    for tag in rules.get(rtype, ()):
+        for elem in glsxml.findall(resource, './/%s' % tag):
+            if elem.get('uri'):
+                uris.add(_absolute_uri(elem.get('uri')))
+    return uris
+
+
+def prefetch(resource):
+    '''
+    Fetch in the background resources referenced by resource that are not 
+    already prefetched or being fetched. Artifacts are fetched with 
+    batch_retrieve(), others with concurrent GETs. Requires enable_prefetch().
+    '''
+    executor = _PREFETCHEXECUTOR
+    if _PREFETCHRULES is None or executor is None:
+        return
+    with _PREFETCHLOCK:
+        uris = { u for u in references(resource) if u not in _PREFETCHED }
+    with _INFLIGHTLOCK:
+        uris -= set(_INFLIGHT)
+    artifacts = sorted(u for u in uris if '/artifacts/' in u)
+    if artifacts and _batch_supported():
+        uris -= set(artifacts)
+        for i in range(0, len(artifacts), _BATCHSIZE):
+            executor.submit(_prefetch_artifacts, artifacts[i:i + _BATCHSIZE])
+    for uri in uris:
+        executor.submit(_prefetch_one, uri)
+
+
+def _prefetch_one(uri):
+    try:
+        _coalesced_get(uri, prefetch=True)
+    except Exception as e:
+        logger.debug('Prefetch of %s failed: %s' % (uri, e))
+
+
+def _prefetch_artifacts(uris):
+    '''
+    Batch retrieve artifacts at uris into the prefetch cache. Artifacts
+    requested without "?state=" are cached under the query-stripped uri.
+    '''
+    flights = {}
+    for uri in uris:
+        flight, leader = _join_flight(uri, prefetch=True)
+        if leader:
+            flights[uri] = flight
+    if not flights:
+        # All claimed by other flights since prefetch() was called
+        return
+    found = {}
+    try:
+        for art in _batch_get(flights):
+            uri = art.get('uri')
+            key = uri if uri in flights else _tracking_key(uri)
+            if key in flights:
+                found[key] = art
+                with _PREFETCHLOCK:
+                    if not flights[key].stale:
+                        _cache_locked(key, art)
+    except Exception as e:
+        logger.debug('Prefetch of %d artifacts failed: %s' % (len(flights), e))
+    finally:
+        # Waiters for anything not found fetch it themselves
+        for uri, flight in flights.items():
+            _land_flight(uri, flight, found.get(uri))
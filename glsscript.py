@@ -24,6 +24,7 @@
     License along with this library. If not, see <http://www.gnu.org/licenses/>
 '''
 import sys
+import atexit
 import argparse
 import os.path
 import logging
@@ -59,6 +60,8 @@ MSGNOLOPTIONSUPPLIED = '''
 No "-l" option supplied at command line'''
 MSGBADPROCESSURI = '''
 Supplied value of "-l" doesn't appear to be a uri''' 
+MSGUNCOMMITTEDWRITES = '''
+Uncaught exception: %d queued glslib writes were not sent'''
 
 
 class ScriptException(Exception):
@@ -216,7 +219,7 @@ class GlsScript(Script):
     ==Class for a CLI script using glslib==
     '''
     def __init__(self, description, logfile=None, servername=None, 
-                 authfile='~/.geneus/gl_credentials.cfg'):
+                 authfile='~/.geneus/gl_credentials.cfg', unitofwork=False):
         '''
         Constructor for GlsScript class. -d, --debug optional argument is added
         to parser
@@ -227,6 +230,10 @@ class GlsScript(Script):
                        to register())
         authfile       Location of GLS authfile
                        (default='~/.geneus/gl_credentials.cfg')  
+        unitofwork     Queue glslib writes and send them only on successful
+                       exit() or explicit self.glslib.commit(). A script 
+                       ending without exit() commits at interpreter exit, 
+                       unless it raised an uncaught exception (default=False)
         '''
         Script.__init__(self, description, logfile)
         self.glslib = glslib
@@ -241,6 +248,11 @@ class GlsScript(Script):
                                  help='Turn on debugging output from glslib')
         if self.servername:
             self.glslib.register(self.servername, self.authfile)
+        self._uncaught = False
+        if unitofwork:
+            self.glslib.begin_unit_of_work()
+            self._set_excepthook()
+            atexit.register(self._end_unit_of_work_atexit)
 
     def parse_args(self, force=False):
         '''
@@ -275,6 +287,53 @@ class GlsScript(Script):
         self.authfile = os.path.expanduser(authfile)
         self.glslib.register(self.servername, self.authfile)
         
+    def exit(self, message='', logmethod='INFO', exitcode=0, email=False):
+        '''
+        If a glslib unit of work is open, commit it on success or discard it
+        on failure (exitcode != 0 or logmethod in {'ERROR', 'CRITICAL'}), 
+        then Script.exit. A failed commit turns success into failure.
+        '''
+        if self.glslib.in_unit_of_work():
+            success = exitcode == 0 and logmethod not in {'ERROR', 'CRITICAL'}
+            try:
+                self.glslib.end_unit_of_work(save=success)
+            except Exception as e:
+                message = '%s\nCommit failed: %s' % (message, e)
+                logmethod, exitcode = 'CRITICAL', 4
+        Script.exit(self, message, logmethod, exitcode, email)
+
+    def _set_excepthook(self):
+        '''
+        Chain sys.excepthook to note that the script died of an uncaught
+        exception, for _end_unit_of_work_atexit()
+        '''
+        excepthook = sys.excepthook
+        def hook(*exc_info):
+            self._uncaught = True
+            excepthook(*exc_info)
+        sys.excepthook = hook
+
+    def _end_unit_of_work_atexit(self):
+        '''
+        atexit hook for a script that ended without exit(). Commit the unit
+        of work if the script ran to the end, or discard it, logging how 
+        many writes were lost, if it died of an uncaught exception. A bare
+        sys.exit() counts as running to the end; use exit() to fail.
+        '''
+        if not self.glslib.in_unit_of_work():
+            return
+        n = self.glslib.pending()
+        if self._uncaught:
+            if n:
+                self.logger.error(MSGUNCOMMITTEDWRITES % n)
+            self.glslib.end_unit_of_work(save=False)
+            return
+        try:
+            # Thread pools are unavailable during interpreter shutdown
+            self.glslib.end_unit_of_work(save=True, workers=1)
+        except Exception as e:
+            self.logger.critical('Commit failed: %s' % e)
+        
         
 class EPPScript(GlsScript):
     '''
@@ -282,7 +341,7 @@ class EPPScript(GlsScript):
     '''
     
     def __init__(self, description, logfile=None, servername=None,
-                 authfile='~/.geneus/gl_credentials.cfg'):
+                 authfile='~/.geneus/gl_credentials.cfg', unitofwork=False):
         '''
         Constructor for EPP script. Processuri is added to parser as first 
         positional argument.
@@ -293,8 +352,11 @@ class EPPScript(GlsScript):
                        to register())
         authfile       Location of GLS authfile 
                        (default='~/.geneus/gl_credentials.cfg')
+        unitofwork     Queue glslib writes until successful exit() 
+                       (default=False)
         '''
-        GlsScript.__init__(self, description, logfile, servername, authfile)
+        GlsScript.__init__(self, description, logfile, servername, authfile,
+                           unitofwork)
         self.processuri = None
         self.parser.add_argument('processuri', 
                             help='processuri of process invoking EPPScript')
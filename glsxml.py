@@ -0,0 +1,235 @@
+'''
+    Python3 xml backend for glslib.
+
+    This module is part of the glslib package and is imported by glslib.py
+
+    Parsing, serialization, find/findall and namespace handling are done by
+    lxml.etree when it is installed, otherwise by the standard library
+    xml.etree.ElementTree. Both give the same results through the functions
+    here. Set environment variable GLSLIB_XML_BACKEND=etree to force the
+    standard library, or call use_backend() before any elements are created.
+    Elements from different backends must not be mixed.
+
+    find() and findall() compile each distinct path once and re-use it; with
+    lxml paths are compiled to XPath (ETXPath, so "{namespace}local" works).
+
+    Run "python -m glsapi.glsxml [nartifacts]" to benchmark the available
+    backends on a synthetic batch retrieve payload.
+
+    This library is free software: you can redistribute it and/or
+    modify it under the terms of the GNU Lesser General Public
+    License as published by the Free Software Foundation, either
+    version 3 of the License, or (at your option) any later version.
+
+    This library is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+    Lesser General Public License for more details.
+
+    You should have received a copy of the GNU Lesser General Public
+    License along with this library. If not, see <http://www.gnu.org/licenses/>
+'''
+import os
+import sys
+import time
+import xml.etree.ElementTree as _stdetree
+try:
+    import lxml.etree as _lxmletree
+except ImportError:
+    _lxmletree = None
+
+BACKENDS = ('lxml', 'etree')
+BACKEND = None
+etree = None
+_NAMESPACES = {}
+_PATHS = {}
+MSGBADBACKEND = '''
+xml backend must be one of %s''' % ', '.join(BACKENDS)
+MSGNOLXML = '''
+lxml backend requested but lxml is not installed'''
+
+
+class GlsxmlException(Exception):
+    pass
+
+
+def available_backends():
+    return [ b for b in BACKENDS if b != 'lxml' or _lxmletree is not None ]
+
+
+def use_backend(name=None):
+    '''
+    Select xml backend 'lxml' or 'etree'. If name is None, use
+    $GLSLIB_XML_BACKEND if set, else lxml if installed, else etree.
+    '''
+    global BACKEND, etree
+    name = name or os.environ.get('GLSLIB_XML_BACKEND')
+    if name is None:
+        name = 'lxml' if _lxmletree is not None else 'etree'
+    if name not in BACKENDS:
+        raise GlsxmlException(MSGBADBACKEND)
+    if name == 'lxml' and _lxmletree is None:
+        raise GlsxmlException(MSGNOLXML)
+    BACKEND = name
+    etree = _lxmletree if name == 'lxml' else _stdetree
+    _PATHS.clear()
+    for prefix, uri in _NAMESPACES.items():
+        etree.register_namespace(prefix, uri)
+
+
+def register_namespaces(nsmap):
+    '''
+    Register {prefix:namespace} so that serialized elements use prefix.
+    '''
+    _NAMESPACES.update(nsmap)
+    for prefix, uri in nsmap.items():
+        etree.register_namespace(prefix, uri)
+
+
+def Element(tag, **extra):
+    return etree.Element(tag, **extra)
+
+
+def SubElement(parent, tag, **extra):
+    return etree.SubElement(parent, tag, **extra)
+
+
+def iselement(obj):
+    return etree.iselement(obj)
+
+
+def fromstring(data):
+    '''
+    Parse string or bytes and return root Element.
+    '''
+    if BACKEND == 'lxml' and isinstance(data, str):
+        # lxml refuses str with an encoding declaration; as with etree the
+        # declaration is ignored for str
+        parser = etree.XMLParser(encoding='utf-8')
+        return etree.fromstring(data.encode('utf-8'), parser)
+    return etree.fromstring(data)
+
+
+def tostring(elem, encoding=None):
+    '''
+    Serialize elem. Return bytes, or str if encoding is 'unicode'.
+    '''
+    if encoding is None:
+        return etree.tostring(elem)
+    return etree.tostring(elem, encoding=encoding)
+
+
+def _compile(path):
+    '''
+    Return function mapping an element to list of matches of path.
+    '''
+    compiled = _PATHS.get(path)
+    if compiled is None:
+        if BACKEND == 'lxml':
+            try:
+                compiled = etree.ETXPath(path)
+            except etree.XPathSyntaxError:
+                pass
+        if compiled is None:
+            compiled = lambda elem: elem.findall(path)
+        _PATHS[path] = compiled
+    return compiled
+
+
+def findall(elem, path):
+    '''
+    Return list of elements matching ElementPath-style path below elem.
+    '''
+    return list(_compile(path)(elem))
+
+
+def find(elem, path):
+    '''
+    Return first element matching path below elem, or None.
+    '''
+    if BACKEND != 'lxml':
+        # Stops at the first match, unlike findall()
+        return elem.find(path)
+    found = _compile(path)(elem)
+    return found[0] if found else None
+
+
+def findtext(elem, path, default=None):
+    '''
+    Return text of first element matching path below elem ('' if it has 
+    none), or default if there is no match.
+    '''
+    found = find(elem, path)
+    if found is None:
+        return default
+    return found.text or ''
+
+
+#------------------------------------
+# Benchmark of the available backends
+#------------------------------------
+def _batch_payload(nartifacts, nudfs):
+    '''
+    Return bytes of a synthetic artifacts/batch/retrieve response
+    '''
+    art = 'http://genologics.com/ri/artifact'
+    udf = 'http://genologics.com/ri/userdefined'
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>',
+             '<art:details xmlns:art="%s" xmlns:udf="%s">' % (art, udf)]
+    for i in range(nartifacts):
+        uri = 'http://example:8080/api/v2/artifacts/2-%d?state=%d' % (i, i)
+        parts.append('<art:artifact limsid="2-%d" uri="%s">' % (i, uri))
+        parts.append('<name>Artifact %d</name><type>Analyte</type>' % i)
+        parts.append('<location><container limsid="27-%d"/>'
+                     '<value>A:1</value></location>' % i)
+        for j in range(nudfs):
+            parts.append('<udf:field type="Numeric" name="UDF %d">%d.5'
+                         '</udf:field>' % (j, j))
+        parts.append('<sample limsid="S%d" uri="http://example:8080/api/v2/'
+                     'samples/S%d"/></art:artifact>' % (i, i))
+    parts.append('</art:details>')
+    return ''.join(parts).encode('utf-8')
+
+
+def benchmark(nartifacts=1000, nudfs=20, repeat=5):
+    '''
+    Time parse, findall and serialize of a batch retrieve payload with each
+    available backend. Return {backend:{step:best seconds}}. The selected
+    backend is restored afterwards.
+    '''
+    payload = _batch_payload(nartifacts, nudfs)
+    path = './/{http://genologics.com/ri/artifact}artifact'
+    original = BACKEND
+    results = {}
+    try:
+        for backend in available_backends():
+            use_backend(backend)
+            timings = {'parse': [], 'findall': [], 'serialize': []}
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                root = fromstring(payload)
+                t1 = time.perf_counter()
+                artifacts = findall(root, path)
+                t2 = time.perf_counter()
+                for a in artifacts:
+                    tostring(a)
+                t3 = time.perf_counter()
+                timings['parse'].append(t1 - t0)
+                timings['findall'].append(t2 - t1)
+                timings['serialize'].append(t3 - t2)
+            results[backend] = { k: min(v) for k, v in timings.items() }
+    finally:
+        use_backend(original)
+    return results
+
+
+use_backend()
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    print('%d artifacts, payload %d bytes' % (n, len(_batch_payload(n, 20))))
+    print('%-8s %10s %10s %10s' % ('backend', 'parse', 'findall', 'serialize'))
+    for backend, t in benchmark(n).items():
+        print('%-8s %9.4fs %9.4fs %9.4fs' % (backend, t['parse'], t['findall'],
+                                            t['serialize']))